@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 
+import functools
+import io
+import mmap
+import os
 import pathlib
+import sys
+import warnings
 import numpy as np
 from matplotlib import pyplot as plt
 
-
 G = 9.81
 
+# per-column factors applied by normalize(): (time, x, y, z)
+_NORM_SCALE = np.array([1.0, -G, -G, G], dtype=np.float64)
+
 FILEPATH = pathlib.Path(__file__).parent / "data" / "accel.csv"
+OUTPUT_PATH = pathlib.Path(__file__).parent / "accel.png"
 
 # times when the train is known to be static
 # tuples of (start_time, end_time)
@@ -21,38 +30,123 @@ KNOWN_ZEROES = [
 ]
 
 
-def csv_data_formatter(raw):
+def is_headless():
     """
-    Converts a raw item read from csv to a float.
-    Quirks:
-    - the decimal separator may be a comma (",") or a dot ("."),
-    - the value may be nevative (heading "-" sign)
-    Takes as input a str, returns a float.
+    Tells whether no display is available to show the figure on.
     """
-    data = raw.replace(",", ".")
-    return float(data)
+    return sys.platform.startswith("linux") and not (
+        os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
+    )
 
 def load_data(path):
     """
     Loads the CSV file, parses it, and yields the measurements
     as tuples of floats (time, (accel_x, accel_y, accel_z)).
     Returns the data as a 2-dimensional NumPy array.
+
+    The parsed array is cached next to the CSV file (same name, ".npy" suffix)
+    and reused as long as it is not older than the CSV file.
+    If the cache cannot be written, the data is still returned.
+    It is also kept in memory, so that later calls with the same path
+    within the process only cost a copy.
+
+    The array is column-major (Fortran order): each serie is contiguous in memory.
     """
-    with open(path) as file:
-        return np.loadtxt(
-            file,
-            delimiter=";",
-            converters={
-                0: csv_data_formatter,
-                1: csv_data_formatter,
-                2: csv_data_formatter,
-                3: csv_data_formatter,
-            },
-            # names=("t", "x..", "y..", "z.."),
-            skiprows=1,
-            usecols=(0, 1, 2, 3),
-            encoding="utf-8",
-        )
+    path = pathlib.Path(path)
+    return _load_data_cached(path).copy(order="F")
+
+@functools.lru_cache(maxsize=4)
+def _load_data_cached(path):
+    """
+    Does the actual work of load_data().
+    The returned array is shared between calls and must not be modified.
+    """
+    cache = path.with_suffix(".npy")
+    if cache.exists() and cache.stat().st_mtime >= path.stat().st_mtime:
+        return np.load(cache)
+
+    arr = parse_csv(path)
+    if arr.shape[0] == 0: # most likely unreadable, keep retrying
+        return arr
+
+    # write to a temporary file first, so that an interrupted write
+    # does not leave a truncated cache behind
+    tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as file:
+            np.save(file, arr)
+        os.replace(tmp, cache)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+
+    return arr
+
+def parse_csv(path, chunk_size=1 << 20):
+    """
+    Parses the CSV file into a 2-dimensional NumPy array
+    of rows (time, accel_x, accel_y, accel_z).
+    The file is memory-mapped and parsed by chunks of about <chunk_size> bytes
+    (cut on line boundaries) straight into the output array,
+    so that memory usage stays close to the size of the output.
+    Lines may end with "\n", "\r\n" or a bare "\r".
+    """
+    # float64 is required for the time column: with float32, the resolution
+    # near the end of the recording (~2600 s) is coarser than the sampling step
+    empty = np.empty((0, 4), dtype=np.float64)
+
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0: # mmap cannot map an empty file
+            return empty
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # "\r\n" line endings end with "\n" too; only a file without
+            # any "\n" uses bare "\r" line endings
+            eol = b"\n" if mm.find(b"\n") != -1 else b"\r"
+
+            start = mm.find(eol) + 1 # skip the header
+            if start == 0: # nothing but the header
+                return empty
+
+            nrows = sum(
+                mm[i:i + chunk_size].count(eol)
+                for i in range(start, size, chunk_size)
+            )
+            if size > start and mm[size - 1:] != eol:
+                nrows += 1 # last line without a line break
+            arr = np.empty((nrows, 4), dtype=np.float64)
+
+            row = 0
+            while start < size:
+                # end the chunk on the first line break after chunk_size bytes
+                stop = mm.find(eol, min(start + chunk_size, size - 1)) + 1
+                if stop == 0: # no line break until the end of the file
+                    stop = size
+                chunk = mm[start:stop]
+                start = stop
+                if eol == b"\r": # np.loadtxt does not split lines on "\r"
+                    chunk = chunk.replace(b"\r", b"\n")
+
+                # the decimal separator may be a comma (",") or a dot (".");
+                # normalize to dots so that NumPy's own float parser can be used
+                with warnings.catch_warnings():
+                    # a chunk may hold nothing but blank lines or comments
+                    warnings.filterwarnings(
+                        "ignore", "loadtxt: input contained no data", UserWarning,
+                    )
+                    parsed = np.loadtxt(
+                        io.BytesIO(chunk.replace(b",", b".")),
+                        delimiter=";",
+                        dtype=np.float64,
+                        # names=("t", "x..", "y..", "z.."),
+                        usecols=(0, 1, 2, 3),
+                        ndmin=2,
+                    )
+                arr[row:row + parsed.shape[0]] = parsed
+                row += parsed.shape[0]
+
+    # blank lines are not rows
+    return arr[:row]
 
 def normalize(data):
     """
@@ -63,11 +157,8 @@ def normalize(data):
     All this is done **in-place**; the modified input array is returned.
     """
 
-    # reorientation
-    data *= (1.0, -1.0, -1.0, 1.0)
-
-    # conversion to S.I.
-    data[::, 1:] *= G
+    # reorientation and conversion to S.I., in a single pass
+    np.multiply(data, _NORM_SCALE, out=data)
 
     return data
 
@@ -79,53 +170,133 @@ def calibrate(times, data, static_times):
     when the system is assumed to be static, i.e. train stops.
 
     static_times is an iterable of pairs (time_start, time_stop)
-    when the system is assumed unmoving.
+    when the system is assumed unmoving. Intervals with no samples in them
+    (including those with time_start >= time_stop) are ignored;
+    samples in overlapping intervals are counted once per interval.
+    times is 1-dimensional and must be sorted in increasing order.
 
     This function operates **in-place** on data: the calibrated input array is returned.
     """
 
-    # 1 when the system is static, 0 otherwise
-    mask = np.any(
-        np.stack(
-            [(start < times) & (times < stop) for start, stop in static_times],
-            axis=1,
-        ),
-        axis=1
-    ).flatten()
+    starts, stops = np.array(list(static_times), dtype=np.float64).T
+
+    # times are increasing: each static interval is a contiguous slice of data
+    lows = np.searchsorted(times, starts, side="right")
+    highs = np.searchsorted(times, stops, side="left")
+    # empty intervals would otherwise give negative lengths
+    highs = np.maximum(highs, lows)
+
+    sums = np.zeros(data.shape[1])
+    count = 0
+    for low, high in zip(lows, highs):
+        sums += data[low:high].sum(axis=0)
+        count += high - low
 
-    bias = np.mean(data[mask, ::], axis=0)
+    bias = sums / count
 
     data -= bias
 
     return data
 
+def decimate(time, values, nbins=2000):
+    """
+    Reduces a (time, values) serie to the minimum and maximum of each of
+    <nbins> consecutive chunks, in their original order.
+    When plotted, the result looks the same as the full serie at screen resolution.
+    Series too short to benefit from it are returned unchanged.
+    """
+    width = values.shape[0] // nbins
+    if width < 3:
+        return time, values
+
+    stop = nbins * width
+    chunks = values[:stop].reshape(nbins, width)
+    lowest = chunks.argmin(axis=1)
+    highest = chunks.argmax(axis=1)
+
+    offsets = np.arange(0, stop, width)
+    indices = np.stack(
+        [np.minimum(lowest, highest), np.maximum(lowest, highest)],
+        axis=1,
+    ) + offsets[::, np.newaxis]
+    # the last few samples that do not fill a whole chunk are kept as is
+    indices = np.concatenate([indices.ravel(), np.arange(stop, values.shape[0])])
+
+    return time[indices], values[indices]
+
 def plot_serie(ax, time, values, legend, ylabel):
     """
     Plots the given value set (1-dim) as a function of time,
     with the relevant title.
+    Only a decimated version of the serie is drawn; it is recomputed
+    over the visible samples whenever the time axis is zoomed or panned.
     Returns the resulting matplotlib.lines.Line2D object.
     """
     ax.set_ylabel(ylabel)
-    ax.grid(which="both", axis="both")
 
-    lines = ax.plot(time, values, label=legend)
+    lines = ax.plot(*decimate(time, values), label=legend)
+
+    def redecimate(ax):
+        low, high = np.searchsorted(time, ax.get_xlim())
+        # keep one more sample on each side, so that the line reaches the edges
+        low = max(low - 1, 0)
+        high = min(high + 1, time.shape[0])
+        lines[0].set_data(*decimate(time[low:high], values[low:high]))
 
-    ax.legend(loc="best")
+    ax.callbacks.connect("xlim_changed", redecimate)
+
+    ax.legend(loc="upper right")
 
     return lines
 
+def integrate_column(half_delta_t, column, out):
+    """
+    Integrates a single serie <column> using the trapezoidal rule,
+    given the half-width of each time step (1 item shorter than <column>).
+    The result is written into <out>, which is returned.
+    """
+    if column.shape[0] == 0:
+        return out
+
+    out[0] = 0.0
+
+    # area of each trapezoid between two consecutive samples
+    np.add(column[1:], column[:-1], out=out[1:])
+    out[1:] *= half_delta_t
+
+    return np.cumsum(out, out=out)
+
 def integrate(times, points):
     """
-    Computes and returns the integral of each column in <points> relative to <time>.
+    Computes and returns the integral of each column in <points> relative to <time>,
+    using the trapezoidal rule. The integral is 0 at the first sample.
     """
-    delta_t = np.diff(times, prepend=0.0, axis=0)
-    return np.cumsum(points * delta_t, axis=0)
+    result = np.empty_like(points)
+    half_delta_t = np.subtract(times[1:], times[:-1])
+    half_delta_t /= 2.0
+
+    for column, out in zip(points.T, result.T):
+        integrate_column(half_delta_t, column, out)
+
+    return result
 
 if __name__ == "__main__":
+    # without a display, render with Agg and save the figure instead of showing it,
+    # unless the user picked a backend themselves
+    headless = is_headless()
+    if headless and "MPLBACKEND" not in os.environ:
+        plt.switch_backend("Agg")
+
+    plt.rcParams.update({
+        "axes.grid": True,
+        "axes.grid.which": "both",
+        "axes.grid.axis": "both",
+    })
+
     arr = load_data(FILEPATH)
     arr = normalize(arr)
 
-    times = arr[::, :1]
+    times = arr[::, 0]
 
     accel = arr[::, 1:]
     accel = calibrate(times, accel, KNOWN_ZEROES)
@@ -155,4 +326,7 @@ if __name__ == "__main__":
 
     # ax_z.set_xlabel("time (s)")
 
-    plt.show()
+    if headless:
+        fig.savefig(OUTPUT_PATH, dpi=100)
+    else:
+        plt.show()